@@ -1,107 +1,243 @@
 import struct
-from time import sleep
-import traceback
+from time import sleep, monotonic
+import logging
 import sys
+import os
+import signal
 import json
+import gzip
 import paho.mqtt.client as mqtt
 import uuid
-from datetime import datetime, timedelta
 import requests
+from requests.adapters import HTTPAdapter
 import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 
 # MQTT topics
 ANNOUNCE_TOPIC = "CO2S/announce"
 DATA_TOPIC = "CO2S/data"
 CONFIG_TOPIC = "CO2S/conf"
 RESET_TOPIC = "CO2S/reset"
+# MQTT 5 shared subscription, the broker splits the data messages between the data clients
+SHARED_DATA_TOPIC = "$share/nexus/" + DATA_TOPIC
+
+# Payload sent through the config topic to make a device reboot (any size other than the config size)
+RESET_PAYLOAD = b'aaaaaaa'
+# Seconds to wait before publishing a config or a reset, so the device has time to subscribe to its config topic
+PUBLISH_DELAY = 2.0
+# Seconds to wait before saving the config file, so several changes are saved at once
+SAVE_DELAY = 1.0
+# Announcements recieved this many seconds after the previous one from the same device are treated as duplicates
+ANNOUNCE_DUPLICATE_SECONDS = 5.0
 
 # Formats for the MQTT payloads
 announceResetStruct = struct.Struct("<16s") # 16 bytes (UUID)
 configStruct = struct.Struct("<5H2h") # 5 unsigned shorts, 2 signed shorts
 dataStruct = struct.Struct("<16s2h") # 16 bytes (UUID), 2 signed shorts
+# Bound unpack methods, used by the MQTT callback
+announceUnpack = announceResetStruct.unpack_from
+dataUnpack = dataStruct.unpack_from
+
+# Ubidots API
+UBIDOTS_URL = "http://industrial.api.ubidots.com"
+UBIDOTS_TIMEOUT = 5 # Seconds to wait for each request
+UBIDOTS_MAX_ATTEMPTS = 6
+UBIDOTS_MAX_RETRY_SECONDS = 30 # Max time spent waiting between retries, the wait doubles after each attempt
+UBIDOTS_RETRY_STATUSES = (408, 429) # Client error statuses that are retried, any other 4xx won't change by retrying
+UBIDOTS_GZIP_MIN_SIZE = 1024 # Payloads bigger than this (in bytes) are sent compressed, if reportConfig.gzipUploads is enabled
 
 # MQTT client and other data structures
+# connectedDevices uses the raw 16 byte UUID as the key
 # Use a lock to prevent the mqtt thread and the main thread to access connectedDevices at the same time
 client : mqtt.Client = None 
+dataClients = [] # Extra clients that only recieve data messages (if mqttConfig.dataClients > 1)
+useSharedData = False # Cleared if the broker rejects the shared subscription, so the main client subscribes to the data topic
+sharedDataLock = threading.Lock()
 configData = {}
 connectedDevices = {}
 connectedLock = threading.Lock()
+ubidotsGzip = False # Set from reportConfig.gzipUploads
+# Reuse the connection to Ubidots between requests
+ubidotsSession = requests.Session()
+ubidotsSession.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0))
+ubidotsSession.headers["Connection"] = "keep-alive"
+# Use orjson to encode the Ubidots payloads if it's installed
+try:
+    from orjson import dumps as dumpJson
+except ImportError:
+    def dumpJson(obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
+# Threads that do the Ubidots uploads, so the main loop never waits for them
+uploader = ThreadPoolExecutor(max_workers=4)
+# Queue of delayed publishes (topic, payload, publish time), handled by publishWorker so the MQTT callback never sleeps
+pendingPublishes = queue.SimpleQueue()
+pendingResets = set()
+pendingResetsLock = threading.Lock()
+# The config file is saved by configWriter, saveLock must be held when modifying configData
+saveRequested = threading.Event()
+saveLock = threading.Lock()
+saveFileLock = threading.Lock() # Held while writing the config file, so only one thread writes it at a time
+# Set to stop the report loop (on SIGTERM)
+stopEvent = threading.Event()
+
+# Decode a data message and add its values to the record of the device
+# Returns the raw UUID, the CO2 and temperature values, and the device record (None if the device isn't connected)
+def handleDataPy(payload, devices, lock):
+    # Get the data from the binary payload (fails if the payload is too small)
+    device, co2, temp = dataUnpack(payload)
+    # The lookup doesn't need the lock, a dict lookup is atomic
+    rec = devices.get(device)
+    if (rec is not None):
+        with lock:
+            rec.co2Sum += co2
+            rec.tempSum += temp
+            rec.count += 1
+    return device, co2, temp, rec
+
+# Use the compiled version of the data handling if it has been built (see setup.py)
+try:
+    from co2sensor_fast import DeviceCounters, handleData
+except ImportError:
+    # Counters used to calculate the mean of a device
+    class DeviceCounters:
+        __slots__ = ("co2Sum", "tempSum", "count")
+
+        def __init__(self):
+            self.co2Sum = 0
+            self.tempSum = 0
+            self.count = 0
+
+    handleData = handleDataPy
+
+# Data stored for each connected device, used to calculate the mean and report it
+class DeviceRecord(DeviceCounters):
+    __slots__ = ("name", "apiName", "uuidStr", "configTopic", "configPayload", "connectedAt")
+
+    def __init__(self, uuidStr: str):
+        super().__init__()
+        self.name = ""
+        self.apiName = ""
+        self.uuidStr = uuidStr # Cached UUID string
+        self.configTopic = "{}/{}".format(CONFIG_TOPIC, uuidStr[24:]) # Config topic, built from the last segment of the UUID
+        self.configPayload = None # Packed config, generated by sendConfig the first time it's needed
+        self.connectedAt = monotonic() # Time of the announcement, to detect duplicated ones
 
 # The callback for when the client receives a CONNACK response from the server.
-def on_connect(client, userdata, flags, rc):
+def on_connect(client, userdata, flags, rc, properties=None):
+    if (rc != 0):
+        logging.error("Connection to the MQTT broker refused: {}".format(rc))
+        return
     print("Connected to ", client._host, "port: ", client._port)
     print("Flags: ", flags, "returned code: ", rc)
 
-    client.subscribe(ANNOUNCE_TOPIC, qos=2)
-    client.subscribe(DATA_TOPIC, qos=0)
+    client.subscribe(ANNOUNCE_TOPIC, qos=1)
+    # The data topic is only subscribed here if the data clients aren't used
+    with sharedDataLock:
+        if (not useSharedData):
+            client.subscribe(DATA_TOPIC, qos=0)
+
+# The callback for when a data client receives a CONNACK response from the server.
+def on_connect_data(client, userdata, flags, rc, properties=None):
+    if (rc != 0):
+        logging.error("Connection of a data client to the MQTT broker refused: {}".format(rc))
+        return
+    print("Data client connected to ", client._host, "port: ", client._port)
+    print("Flags: ", flags, "returned code: ", rc)
+
+    client.subscribe(SHARED_DATA_TOPIC, qos=0)
+
+# The callback for when a data client receives a SUBACK response from the server.
+def on_subscribe_data(dataClient, userdata, mid, reasonCodes, properties=None):
+    global useSharedData
+    # Reason codes of 0x80 or above mean the subscription failed (0x9E: shared subscriptions not supported)
+    if all(reasonCode.value < 0x80 for reasonCode in reasonCodes):
+        return
+    with sharedDataLock:
+        if (not useSharedData):
+            return
+        print("The broker rejected the shared subscription ({}), recieving the data with a single client".format(reasonCodes[0]))
+        useSharedData = False
+        # If the main client isn't connected yet, on_connect subscribes instead
+        client.subscribe(DATA_TOPIC, qos=0)
+    for otherClient in dataClients:
+        otherClient.disconnect()
 
 # The callback for when a message is published. (Unused)
 def on_publish(client, userdata, mid):
     pass
 
 # The callback for when a MQTT message is recieved
-def on_message(client, userdata, msg):
-    global connectedLock
+# The globals it uses are bound as default arguments, so they are accessed as locals
+def on_message(client, userdata, msg, _devices=connectedDevices, _lock=connectedLock, _announceUnpack=announceUnpack,
+               _handleData=handleData, _UUID=uuid.UUID, _ANNOUNCE=ANNOUNCE_TOPIC, _DATA=DATA_TOPIC, _CONFIG=CONFIG_TOPIC, _monotonic=monotonic):
+    topic = msg.topic
     # Announcement message recieved
-    if (msg.topic == ANNOUNCE_TOPIC):
-        with connectedLock:
-            try:
-                # Make sure it's the proper size
-                assert len(msg.payload) == announceResetStruct.size
-                # Get the UUID
-                newDevice = uuid.UUID(bytes=announceResetStruct.unpack(msg.payload)[0])
-                # Check the device is already connected
-                if (newDevice in connectedDevices):
-                    # The device may have rebooted due to error, so we remove it before connecting again
-                    del connectedDevices[newDevice]
-                # Initialize the values to calculate the mean
-                connectedDevices[newDevice] = [0, 0, 0] # CO2, temp, times
-                # Print and send the config
-                print("{} has connected ({})!".format(getDeviceName(newDevice), str(newDevice)))
-                sendConfig(newDevice)
-            except:
-                print("Got corrupted annoucement data!")
-                traceback.print_exc()
-                pass
+    if (topic == _ANNOUNCE):
+        try:
+            # Get the raw UUID (fails if the payload is too small)
+            newDevice = _announceUnpack(msg.payload)[0]
+            oldRec = _devices.get(newDevice)
+            # If it's a duplicate, ignore it: its config is already queued, and the device reboots if it recieves a second one
+            if (oldRec is not None and oldRec.configPayload is not None and _monotonic() - oldRec.connectedAt < ANNOUNCE_DUPLICATE_SECONDS):
+                return
+            # Initialize the values to calculate the mean
+            rec = DeviceRecord(str(_UUID(bytes=newDevice)))
+            # If the device was already connected, reuse its packed config (the config isn't modified while running)
+            if (oldRec is not None):
+                rec.name = oldRec.name
+                rec.apiName = oldRec.apiName
+                rec.configPayload = oldRec.configPayload
+            # Print and send the config
+            print("{} has connected ({})!".format(getDeviceName(rec.uuidStr), rec.uuidStr))
+            sendConfig(rec)
+            # If the device was already connected it may have rebooted due to error, so its previous data is replaced
+            with _lock:
+                _devices[newDevice] = rec
+        except struct.error:
+            print("Got annoucement data with the wrong size!")
+        except (KeyError, ValueError):
+            logging.exception("Got corrupted annoucement data!")
     # Data message recieved
-    if (msg.topic == DATA_TOPIC):
+    elif (topic == _DATA):
         try:
-            # Make sure it's the proper size
-            assert len(msg.payload) == dataStruct.size
-            # Get the data from the binary payload
-            data = dataStruct.unpack(msg.payload)
-            # Obtain its UUID
-            device = uuid.UUID(bytes=data[0])
+            # Decode the data and store it to calculate the mean later
+            device, co2, temp, rec = _handleData(msg.payload, _devices, _lock)
             # If the device has not announced its presence, tell it to reboot by sending a 7 byte payload through the config topic
-            if (not device in connectedDevices):
-                print("Unrecognized device: {}".format(str(device)))
-                sleep(2)
-                client.publish(CONFIG_TOPIC + "/" + str(device)[24:], b'aaaaaaa')
-            # Print the recieved values and store them to calculate the mean later
+            if (rec is None):
+                uuidStr = str(_UUID(bytes=device))
+                print("Unrecognized device: {}".format(uuidStr))
+                queueReset("{}/{}".format(_CONFIG, uuidStr[24:]))
+            # Print the recieved values
             else:
-                with connectedLock:
-                    print("{} ({}): CO2: {}ppm, Temp: {}ºC".format(getDeviceName(device), str(device), data[1], data[2]))
-                    connectedDevices[device][0] += data[1]
-                    connectedDevices[device][1] += data[2]
-                    connectedDevices[device][2] += 1
-        except:
-            print("Got corrupted annoucement data!")
-            traceback.print_exc()
-            pass
-    pass
+                print("{} ({}): CO2: {}ppm, Temp: {}ºC".format(rec.name, rec.uuidStr, co2, temp))
+        except struct.error:
+            print("Got data with the wrong size!")
+        except (KeyError, ValueError):
+            logging.exception("Got corrupted data!")
 
-# Get the device name from its UUID
-def getDeviceName(device: uuid.UUID):
+# Get the device name from its UUID string
+def getDeviceName(uuidStr: str):
     global configData
     try:
-        return configData["devices"][str(device)]["name"]
-    except:
+        return configData["devices"][uuidStr]["name"]
+    except KeyError:
         return ""
 
-# Send the device configuration from its UUID
-def sendConfig(device: uuid.UUID):
+# Send the device configuration from its connected device record
+def sendConfig(rec: DeviceRecord):
+    if (rec.configPayload is None):
+        try:
+            rec.configPayload = packConfig(rec)
+        except Exception:
+            logging.exception("Failed to pack config data!")
+            return
+    queuePublish(rec.configTopic, rec.configPayload)
+
+# Get the binary config payload of a device, generating its config if it's the first time it's connected
+def packConfig(rec: DeviceRecord, _pack=configStruct.pack):
     global configData
-    uuidStr = str(device)
+    uuidStr = rec.uuidStr
     if not uuidStr in configData["devices"]:
         # First time this device is connected, generate config
         newConf = {}
@@ -109,32 +245,72 @@ def sendConfig(device: uuid.UUID):
         newConf["usesGlobalConfig"] = True # CONF: Wether to use the global config or the decive specific config
         newConf["apiName"] = "XXXX" # CONF: Name of the device in Ubidots
         newConf["config"] = dict.copy(configData["globalConf"]) # The config entries are generated anyways, so that the user can edit them
-        configData["devices"][uuidStr] = newConf
+        with saveLock:
+            configData["devices"][uuidStr] = newConf
         print("Generating configuration for {} ({})".format(newConf["name"], uuidStr))
         # Save the config to the config file
-        saveConfig()
+        saveRequested.set()
+    deviceConf = configData["devices"][uuidStr]
+    # Cache the names, so the MQTT callback doesn't need to access the config
+    rec.name = deviceConf["name"]
+    rec.apiName = deviceConf["apiName"]
     # Calculate which config data to use
-    useConf = configData["globalConf"] if configData["devices"][uuidStr]["usesGlobalConfig"] else configData["devices"][uuidStr]["config"]
-    try:
-        # Pack the config into a binary payload and send it
-        cBinaryData = configStruct.pack(useConf["measureEachMsec"], useConf["sendAfterMeasures"],
-                                        useConf["greenLEDThreshold"], useConf["yellowLEDThreshold"], useConf["orangeLEDThreshold"],
-                                        useConf["makeBuzzEverySec"], useConf["enableLEDEverySec"])
-        sleep(2)
-        client.publish(CONFIG_TOPIC + "/" + uuidStr[24:], cBinaryData)
-    except:
-        print("Failed to send config data!")
-        traceback.print_exc()
+    useConf = configData["globalConf"] if deviceConf["usesGlobalConfig"] else deviceConf["config"]
+    # Pack the config into a binary payload
+    return _pack(useConf["measureEachMsec"], useConf["sendAfterMeasures"],
+                 useConf["greenLEDThreshold"], useConf["yellowLEDThreshold"], useConf["orangeLEDThreshold"],
+                 useConf["makeBuzzEverySec"], useConf["enableLEDEverySec"])
+
+# Queue a payload to be published after the specified delay
+def queuePublish(topic: str, payload: bytes, delay: float = PUBLISH_DELAY):
+    pendingPublishes.put((topic, payload, monotonic() + delay))
+
+# Queue a reset for a device, unless there is already one pending for the same topic
+def queueReset(topic: str):
+    with pendingResetsLock:
+        if topic in pendingResets:
+            return
+        pendingResets.add(topic)
+    queuePublish(topic, RESET_PAYLOAD)
+
+# Publish the queued payloads once their delay has passed (runs in its own thread)
+def publishWorker():
+    while True:
+        topic, payload, publishTime = pendingPublishes.get()
+        delay = publishTime - monotonic()
+        if delay > 0:
+            sleep(delay)
+        if payload is RESET_PAYLOAD:
+            with pendingResetsLock:
+                pendingResets.discard(topic)
+        try:
+            client.publish(topic, payload)
+        except Exception:
+            logging.exception("Failed to publish to {}!".format(topic))
 
 # Save the configuration data in JSON format to the config file
 def saveConfig():
     global configData
     try:
-        with open(sys.argv[1], "w") as f:
-            json.dump(configData, f, indent=4)
-    except:
-        print("Failed to save configuration file:")
-        traceback.print_exc()
+        # Serialize while locked, so the config isn't modified in the middle
+        with saveLock:
+            configJson = json.dumps(configData, indent=4)
+        # Write to a temporary file and replace the config file with it, so it's never left half written
+        with saveFileLock:
+            tempPath = sys.argv[1] + ".tmp"
+            with open(tempPath, "w") as f:
+                f.write(configJson)
+            os.replace(tempPath, sys.argv[1])
+    except Exception:
+        logging.exception("Failed to save configuration file:")
+
+# Save the config file when requested, waiting a bit to save several changes at once (runs in its own thread)
+def configWriter():
+    while True:
+        saveRequested.wait()
+        sleep(SAVE_DELAY)
+        saveRequested.clear()
+        saveConfig()
 
 # Load the default configuration data (in case it's missing)
 def loadConfigDefault():
@@ -156,11 +332,13 @@ def loadConfigDefault():
     reportConfig["co2VariableName"] = "XXXX" # CONF: Ubidots CO2 variable name
     reportConfig["tempVariableName"] = "XXXX" # CONF: Ubidots temperature name
     reportConfig["reportEverySeconds"] = 300.0 # CONF: Interval to calculate the mean and upload to Ubidots
+    reportConfig["gzipUploads"] = False # CONF: Compress big uploads to Ubidots with gzip. Only enable it if the server accepts compressed requests
     configData["reportConfig"] = reportConfig
 
     mqttConfig = {}
     mqttConfig["address"] = "localhost" # CONF: Address of the MQTT broker
     mqttConfig["port"] = 1883 # CONF: Port of the MQTT broker
+    mqttConfig["dataClients"] = 1 # CONF: Amount of MQTT clients that recieve the data messages. Values above 1 use a shared subscription and need a MQTT 5 broker
     configData["mqttConfig"] = mqttConfig
 
 # Load the configuration from the config file
@@ -170,12 +348,11 @@ def loadConfig():
     try:
         fConfig = open(sys.argv[1], "r")
         configData = json.load(fConfig)
-    except:
+    except (OSError, ValueError):
         if (fConfig is None):
             print("Config file is missing. generating new file...")
         else:
-            print("Config file is corrupted.")
-            traceback.print_exc()
+            logging.exception("Config file is corrupted.")
             fConfig.close()
             sys.exit(1)
         loadConfigDefault()
@@ -185,89 +362,178 @@ def loadConfig():
 
 # Send the specified payload to Ubidots using the device name
 def sendUbidotsPayload(payload, deviceName):
-    global configData
-    # Creates the headers for the HTTP requests
-    url = "http://industrial.api.ubidots.com"
-    url = "{}/api/v1.6/devices/{}".format(url, deviceName)
-    headers = {"X-Auth-Token": configData["reportConfig"]["token"], "Content-Type": "application/json"}
+    req = postUbidots("{}/api/v1.6/devices/{}".format(UBIDOTS_URL, deviceName), payload)
+    return req is not None and req.status_code < 400
+
+# Upload the snapshot of the device means to Ubidots without waiting for the result, using one request per device
+# The snapshot is a list of (UUID string, API name, CO2 mean, temperature mean)
+def uploadSnapshot(snapshot, co2Var, tempVar):
+    for uuidStr, apiName, co2Mean, tempMean in snapshot:
+        payload = {co2Var: co2Mean, tempVar: tempMean}
+        uploader.submit(sendUbidotsPayload, payload, apiName).add_done_callback(onUploadDone)
 
-    # Makes the HTTP requests and sends the payload through POST
+# Called when an upload to Ubidots has finished
+def onUploadDone(future):
+    error = future.exception()
+    if error is not None:
+        logging.error("Failed to upload data to Ubidots:", exc_info=error)
+    elif not future.result():
+        print("Ubidots rejected the uploaded data")
+
+# Send the specified payload to the Ubidots URL
+# Returns the response of the last attempt, or None if it couldn't connect
+def postUbidots(url, payload):
+    # Creates the headers for the HTTP requests (the API token is already set in the session headers)
+    headers = {"Content-Type": "application/json"}
+    # Encode the payload once for all the attempts, compressing it if it's big and compression is enabled
+    body = dumpJson(payload)
+    if ubidotsGzip and len(body) > UBIDOTS_GZIP_MIN_SIZE:
+        body = gzip.compress(body)
+        headers["Content-Encoding"] = "gzip"
+
+    # Makes the HTTP requests and sends the payload through POST, retrying with exponential backoff
+    req = None
     status = 400
     attempts = 0
-    while status >= 400 and attempts <= 5:
-        req = requests.post(url=url, headers=headers, json=payload)
-        status = req.status_code
+    retryDelay = 1
+    retryDeadline = monotonic() + UBIDOTS_MAX_RETRY_SECONDS
+    while True:
+        error = None
+        try:
+            req = ubidotsSession.post(url=url, headers=headers, data=body, timeout=UBIDOTS_TIMEOUT)
+            status = req.status_code
+        except requests.RequestException as e:
+            req = None
+            error = e
+            status = 400
         attempts += 1
-        sleep(1)
+        if status < 400 or (error is None and status < 500 and status not in UBIDOTS_RETRY_STATUSES):
+            break
+        if attempts >= UBIDOTS_MAX_ATTEMPTS or monotonic() + retryDelay > retryDeadline:
+            break
+        logging.warning("Ubidots upload attempt {} failed ({}), retrying in {}s".format(attempts, error if error is not None else status, retryDelay))
+        sleep(retryDelay)
+        retryDelay *= 2
+
+    # Show the results, with the traceback if the last attempt couldn't connect
+    if error is not None:
+        logging.error("Failed to connect to Ubidots:", exc_info=error)
+    else:
+        print(req.status_code, req.text)
+
+    return req
+
+# Create a MQTT client
+def createClient(onConnect, protocol):
+    if (protocol == mqtt.MQTTv5):
+        newClient = mqtt.Client(client_id="", 
+                            userdata=None, 
+                            protocol=protocol, 
+                            transport="tcp")
+    else:
+        newClient = mqtt.Client(client_id="", 
+                            clean_session=True, 
+                            userdata=None, 
+                            protocol=protocol, 
+                            transport="tcp")
 
-    # Show the results
-    print(req.status_code, req.json())
-    if status >= 400:
-        return False
+    # Set the MQTT callbacks
+    newClient.on_connect = onConnect
+    newClient.on_message = on_message
+    return newClient
+
+# Connect a MQTT client and start its loop
+def startClient(newClient):
+    global configData
+    # Set the MQTT user and password (not implemented) and connect
+    newClient.username_pw_set(None, password=None)
+    if (newClient._protocol == mqtt.MQTTv5):
+        newClient.connect(configData["mqttConfig"]["address"], port=configData["mqttConfig"]["port"], keepalive=60, clean_start=True)
+    else:
+        newClient.connect(configData["mqttConfig"]["address"], port=configData["mqttConfig"]["port"], keepalive=60)
 
-    return True
+    # Start the MQTT loop
+    newClient.loop_start()
+    return newClient
 
 # Main method
 def main():
     global client
     global configData
     global connectedLock
+    global useSharedData
+    global ubidotsGzip
     if (len(sys.argv) != 2):
         print("Invalid arguments\nUsage: {} (configFile)".format(sys.argv[0]))
         sys.exit(1)
     
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+
     # Load the configuration
     loadConfig()
 
-    # Init the MQTT client
-    client = mqtt.Client(client_id="", 
-                        clean_session=True, 
-                        userdata=None, 
-                        protocol=mqtt.MQTTv311, 
-                        transport="tcp")
+    # Init the MQTT client, used for the announcements and to send the config
+    # If there is more than one data client, the data messages are split between them using a shared subscription (needs MQTT 5)
+    dataClientCount = configData["mqttConfig"].get("dataClients", 1)
+    useSharedData = dataClientCount > 1
+    protocol = mqtt.MQTTv5 if useSharedData else mqtt.MQTTv311
+    client = createClient(on_connect, protocol)
+    for i in range(dataClientCount if useSharedData else 0):
+        dataClient = createClient(on_connect_data, protocol)
+        dataClient.on_subscribe = on_subscribe_data
+        dataClients.append(dataClient)
+    for dataClient in dataClients:
+        startClient(dataClient)
+    startClient(client)
+    print("Started MQTT listener.")
 
-    # Set the MQTT callbacks
-    client.on_connect = on_connect
-    client.on_message = on_message
+    # Start the thread that publishes the configs and resets
+    threading.Thread(target=publishWorker, daemon=True).start()
+    # Start the thread that saves the config file
+    threading.Thread(target=configWriter, daemon=True).start()
 
-    # Set the MQTT user and password (not implemented) and connect
-    client.username_pw_set(None, password=None)
-    client.connect(configData["mqttConfig"]["address"], port=configData["mqttConfig"]["port"], keepalive=60)
 
-    # Start the MQTT loop
-    client.loop_start()
-    print("Started MQTT listener.")
+    # The report config isn't modified while running, so it's only read once
+    reportInterval = configData["reportConfig"]["reportEverySeconds"]
+    co2Var = configData["reportConfig"]["co2VariableName"]
+    tempVar = configData["reportConfig"]["tempVariableName"]
+    ubidotsSession.headers["X-Auth-Token"] = configData["reportConfig"]["token"]
+    ubidotsGzip = configData["reportConfig"].get("gzipUploads", False)
 
+    # Stop cleanly when terminated, the same way as with Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopEvent.set())
 
-    lastDataSent = datetime.now()
+    nextReport = monotonic() + reportInterval
 
     try:
-        while True:
-            # When it's time to send the data...
-            if (datetime.now() - lastDataSent > timedelta(seconds=configData["reportConfig"]["reportEverySeconds"])):
-                if (len(connectedDevices) == 0):
-                    lastDataSent = datetime.now()
-                    continue
-                # For each device connected
-                with connectedLock:
-                    for device in connectedDevices:
-                        deviceData = connectedDevices[device]
-                        if (deviceData[2] == 0):
-                            continue
-                        # Generate the mean of CO2 and temperature and send it to Ubidots using the config
-                        co2Mean = deviceData[0] // deviceData[2]
-                        tempMean = deviceData[1] // deviceData[2]
-                        print("Sending data for {}: CO2: {}ppm, Temp: {}ºC".format(str(device), co2Mean, tempMean))
-                        sendUbidotsPayload({configData["reportConfig"]["co2VariableName"]: co2Mean, configData["reportConfig"]["tempVariableName"]: tempMean}, configData["devices"][str(device)]["apiName"])
-                        # Reset the data to start calculating the mean again
-                        connectedDevices[device] = [0, 0, 0]
-                lastDataSent = datetime.now()
-            sleep(0.1)
+        # Sleep until it's time to send the data
+        while not stopEvent.wait(max(0, nextReport - monotonic())):
+            nextReport = monotonic() + reportInterval
+            # Generate the mean of CO2 and temperature of each device connected
+            # Only the calculation is done while locked, the HTTP requests are done afterwards
+            snapshot = []
+            with connectedLock:
+                for rec in connectedDevices.values():
+                    if (rec.count == 0):
+                        continue
+                    snapshot.append((rec.uuidStr, rec.apiName, rec.co2Sum // rec.count, rec.tempSum // rec.count))
+                    # Reset the data to start calculating the mean again
+                    rec.co2Sum = rec.tempSum = rec.count = 0
+            for uuidStr, apiName, co2Mean, tempMean in snapshot:
+                print("Sending data for {}: CO2: {}ppm, Temp: {}ºC".format(uuidStr, co2Mean, tempMean))
+            if (snapshot):
+                uploadSnapshot(snapshot, co2Var, tempVar)
     except KeyboardInterrupt:
         pass
     
     print("Exiting...")
     client.loop_stop()
+    for dataClient in dataClients:
+        dataClient.loop_stop()
+    # Save any config changes that are still pending
+    if saveRequested.is_set():
+        saveConfig()
+    uploader.shutdown(wait=False, cancel_futures=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,45 @@
+# cython: language_level=3
+# Compiled version of the data message handling of co2sensorNexus.py (optional, see setup.py)
+import struct
+
+# Size of the data payload: 16 bytes (UUID), 2 signed shorts
+cdef enum:
+    DATA_SIZE = 20
+
+# Counters used to calculate the mean of a device, DeviceRecord extends this class
+cdef class DeviceCounters:
+    cdef public long long co2Sum
+    cdef public long long tempSum
+    cdef public long long count
+
+# Read a little endian signed short from the payload
+cdef inline short readShort(const unsigned char* payload, Py_ssize_t offset):
+    return <short>(payload[offset] | (payload[offset + 1] << 8))
+
+# Decode a data message and add its values to the record of the device
+# Returns the raw UUID, the CO2 and temperature values, and the device record (None if the device isn't connected)
+# Like handleDataPy, it accepts any buffer, but bytes (what paho gives) is read without copying
+cpdef tuple handleData(object payload, dict devices, object lock):
+    cdef bytes raw
+    cdef const unsigned char* data
+    cdef short co2
+    cdef short temp
+    cdef DeviceCounters counters
+    if type(payload) is bytes:
+        raw = <bytes>payload
+    else:
+        raw = bytes(memoryview(payload))
+    if len(raw) < DATA_SIZE:
+        raise struct.error("unpack_from requires a buffer of at least {} bytes".format(DATA_SIZE))
+    data = raw
+    device = raw[:16]
+    co2 = readShort(data, 16)
+    temp = readShort(data, 18)
+    rec = devices.get(device)
+    if rec is not None:
+        counters = <DeviceCounters?>rec
+        with lock:
+            counters.co2Sum += co2
+            counters.tempSum += temp
+            counters.count += 1
+    return device, co2, temp, rec
@@ -0,0 +1,9 @@
+# Builds the optional compiled data message handling used by co2sensorNexus.py
+# Usage: python setup.py build_ext --inplace
+from setuptools import setup
+from Cython.Build import cythonize
+
+setup(
+    name="co2sensor_fast",
+    ext_modules=cythonize("co2sensor_fast.pyx"),
+)